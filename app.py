@@ -4,7 +4,6 @@ warnings.simplefilter(action='ignore', category=FutureWarning)
 warnings.filterwarnings("ignore", category=UserWarning, module="google.genai")
 
 import streamlit as st
-import pandas as pd
 import plotly.express as px
 import os
 import re
@@ -12,7 +11,8 @@ import json
 import csv
 from fpdf import FPDF
 from datetime import datetime
-from chatbot_logic import check_safety_local, ask_gemini_rotated, get_fallback_response
+from chatbot_logic import check_safety_local, ask_gemini_shared, get_fallback_response, TokenBucket
+from savings_logic import PROFILO_DEFAULT, rules_hash, compute_scenario, track_node_changes, decode_profile, normalize_profile, sync_query_params
 
 # --- CONFIGURAZIONE PAGINA ---
 st.set_page_config(
@@ -100,7 +100,16 @@ def load_data():
         return RULES, True
 
 RULES_LOADED, data_loaded = load_data()
+RULES_VERSION = rules_hash(RULES_LOADED)
 
+# Profilo pre-compilato dal link condiviso (letto solo al primo caricamento della sessione)
+if "profilo_iniziale" not in st.session_state:
+    st.session_state.profilo_iniziale = decode_profile(query_params, [p['name'] for p in RULES_LOADED['partners_list']])
+    # Chi arriva da un link condiviso ha già il profilo nel link: lo manteniamo
+    st.session_state.condividi_link = any(nome in query_params for nome in PROFILO_DEFAULT)
+profilo_iniziale = st.session_state.profilo_iniziale
+
+@st.cache_data(max_entries=500, show_spinner=False)
 def create_pdf(piano, vantaggio_netto, dettagli):
     pdf = FPDF()
     pdf.add_page()
@@ -162,6 +171,10 @@ with st.sidebar:
     if "messages" not in st.session_state:
         st.session_state.messages = [{"role": "assistant", "content": "Ciao! Chiedimi info sui piani (es. 'Conviene il Metal?')."}]
 
+    # Limite per sessione: 5 domande di scorta, poi una ogni 20 secondi
+    if "chat_bucket" not in st.session_state:
+        st.session_state.chat_bucket = TokenBucket(capacity=5, refill_per_sec=1/20)
+
     # Container per i messaggi (così l'input resta in basso)
     chat_container = st.container(height=400) # Altezza fissa scrollabile
 
@@ -185,10 +198,12 @@ with st.sidebar:
                  response_text = f"🚫 {error_msg}"
             else:
                 with st.spinner("..."):
-                    ai_response = ask_gemini_rotated(prompt, RULES_LOADED)
+                    ai_response, limitato = ask_gemini_shared(prompt, RULES_LOADED, RULES_VERSION, st.session_state.chat_bucket)
 
                 if ai_response:
                     response_text = ai_response
+                elif limitato:
+                    response_text = "⏳ Troppe domande in poco tempo, riprova tra poco. Intanto ecco una risposta rapida:\n\n" + get_fallback_response(prompt)
                 else:
                     response_text = get_fallback_response(prompt)
 
@@ -276,36 +291,36 @@ with st.container(border=True):
 
     with c1:
         st.markdown("**🏦 Banca Attuale**")
-        canone = st.number_input("Canone (€/mese)", value=10.0, step=1.0, min_value=0.0)
-        bonifici_istantanei = st.number_input("Bonifici Istantanei (n/anno)", value=12, min_value=0)
-        costo_bonifico = st.number_input("Costo Unitario Bonifico (€)", value=2.00, step=0.10, min_value=0.0)
-        pagopa = st.number_input("PagoPA (n/anno)", value=12, min_value=0)
-        costo_pagopa = st.number_input("Costo Unitario PagoPA (€)", value=1.50, step=0.10, min_value=0.0)
+        canone = st.number_input("Canone (€/mese)", value=profilo_iniziale['canone'], step=1.0, min_value=0.0)
+        bonifici_istantanei = st.number_input("Bonifici Istantanei (n/anno)", value=profilo_iniziale['bonifici_istantanei'], min_value=0)
+        costo_bonifico = st.number_input("Costo Unitario Bonifico (€)", value=profilo_iniziale['costo_bonifico'], step=0.10, min_value=0.0)
+        pagopa = st.number_input("PagoPA (n/anno)", value=profilo_iniziale['pagopa'], min_value=0)
+        costo_pagopa = st.number_input("Costo Unitario PagoPA (€)", value=profilo_iniziale['costo_pagopa'], step=0.10, min_value=0.0)
 
     with c2:
         st.markdown("**💳 Utilizzo Carta**")
-        spese = st.number_input("Spesa carta mensile (€)", value=400.0, step=50.0, min_value=0.0)
-        viaggi = st.number_input("Viaggi all'estero (n/anno)", value=2, min_value=0)
-        spesa_prelievi_mensile = st.number_input("Spesa prelievi mensile (€)", value=0.0, step=10.0, min_value=0.0, help="Inserisci la spesa mensile per prelievi ATM. Se 0, verrà stimata in base ai viaggi.")
-        liquidita_media = st.number_input("Liquidità Media (€)", value=1000.0, step=100.0, min_value=0.0, help="Soldi che tieni sul conto (Salvadanaio/Flessibile) che generano interessi")
+        spese = st.number_input("Spesa carta mensile (€)", value=profilo_iniziale['spese'], step=50.0, min_value=0.0)
+        viaggi = st.number_input("Viaggi all'estero (n/anno)", value=profilo_iniziale['viaggi'], min_value=0)
+        spesa_prelievi_mensile = st.number_input("Spesa prelievi mensile (€)", value=profilo_iniziale['spesa_prelievi_mensile'], step=10.0, min_value=0.0, help="Inserisci la spesa mensile per prelievi ATM. Se 0, verrà stimata in base ai viaggi.")
+        liquidita_media = st.number_input("Liquidità Media (€)", value=profilo_iniziale['liquidita_media'], step=100.0, min_value=0.0, help="Soldi che tieni sul conto (Salvadanaio/Flessibile) che generano interessi")
 
     with c3:
         st.markdown("**🌍 Extra & Pro**")
-        lounge = st.number_input("Ingressi Lounge (n/anno)", value=1, min_value=0)
-        bonifici_int = st.number_input("Bonifici Extra-UE (n/anno)", value=2, min_value=0)
-        revolut_pro = st.number_input("Revolut Pro (€/mese)", value=100.0, min_value=0.0, help="Inserisci valore solo se hai P.IVA/Freelance. Offre cashback elevato")
+        lounge = st.number_input("Ingressi Lounge (n/anno)", value=profilo_iniziale['lounge'], min_value=0)
+        bonifici_int = st.number_input("Bonifici Extra-UE (n/anno)", value=profilo_iniziale['bonifici_int'], min_value=0)
+        revolut_pro = st.number_input("Revolut Pro (€/mese)", value=profilo_iniziale['revolut_pro'], min_value=0.0, help="Inserisci valore solo se hai P.IVA/Freelance. Offre cashback elevato")
 
     with c4:
         st.markdown("**📈 Investimenti**")
-        volume_crypto = st.number_input("Vol. Crypto mensile (€)", value=0.0, min_value=0.0)
-        volume_borsa = st.number_input("Vol. Azioni mensile (€)", value=0.0, min_value=0.0)
+        volume_crypto = st.number_input("Vol. Crypto mensile (€)", value=profilo_iniziale['volume_crypto'], min_value=0.0)
+        volume_borsa = st.number_input("Vol. Azioni mensile (€)", value=profilo_iniziale['volume_borsa'], min_value=0.0)
 
 st.markdown("---")
 opt1, opt2 = st.columns(2)
 with opt1:
-    fatturazione_annuale = st.toggle("Fatturazione Annuale (Risparmio ~20%)", value=True)
+    fatturazione_annuale = st.toggle("Fatturazione Annuale (Risparmio ~20%)", value=profilo_iniziale['fatturazione_annuale'])
 with opt2:
-    modalita_duo = st.checkbox("Modalità Duo (x2 Persone)", help="Risparmia fino al 36% attivando un piano per te e un partner o familiare. Include 2 account completi.")
+    modalita_duo = st.checkbox("Modalità Duo (x2 Persone)", value=profilo_iniziale['modalita_duo'], help="Risparmia fino al 36% attivando un piano per te e un partner o familiare. Include 2 account completi.")
 membri_duo = 2 if modalita_duo else 1
 
 # --- SEZIONE ABBONAMENTI PARTNER ---
@@ -319,95 +334,46 @@ with st.container(border=True):
     selected_partners = st.multiselect(
         "Quali di questi servizi usi o useresti se fossero gratis?",
         options=partner_map.keys(),
-        default=[],
+        default=profilo_iniziale['selected_partners'],
         format_func=lambda x: f"{x} (€{partner_map[x]['val']}/anno)",
         help="Seleziona i servizi che utilizzi o potresti utilizzare. Il valore verrà aggiunto al calcolo del vantaggio per i piani che li includono."
     )
 
 # CALCOLI
-results = []
+# Input dei nodi all'ultimo rerun: serve solo a mostrare cosa è cambiato
+if "calc_memo" not in st.session_state:
+    st.session_state.calc_memo = {}
+
 if data_loaded:
-    for piano in RULES_LOADED['piani']:
-        # Costo Abbonamento
-        if fatturazione_annuale:
-            base = RULES_LOADED['piani'][piano]['costo_annuale']
-        else:
-            base = RULES_LOADED['piani'][piano]['costo_mensile'] * 12
-        if modalita_duo:
-            costo_abbonamento = base + (RULES_LOADED['piani'][piano]['costo_duo_addon'] * 12)
-        else:
-            costo_abbonamento = base
-
-        # Calcolo Commissioni & Risparmi
-        # Prelievi ATM
-        spesa_prelievi_annui = spesa_prelievi_mensile * 12 if spesa_prelievi_mensile > 0 else viaggi * 200
-        costo_banca_atm = (viaggi * 3) * RULES_LOADED['benchmark_banca']['fee_atm_altri']
-        eccedenza_atm = max(0, spesa_prelievi_annui - (RULES_LOADED['piani'][piano]['limiti']['prelievi_atm'] * 12))
-        fee_revolut_atm = eccedenza_atm * RULES_LOADED['piani'][piano]['commissioni']['prelievi_atm_over']
-        risparmio_atm = costo_banca_atm - fee_revolut_atm
-
-        # Cambio Valuta
-        spesa_fx_annua = viaggi * 500
-        costo_banca_fx = spesa_fx_annua * RULES_LOADED['benchmark_banca']['fee_cambio_valuta']
-        eccedenza_fx = max(0, spesa_fx_annua - (RULES_LOADED['piani'][piano]['limiti']['cambio_valuta'] * 12))
-        fee_revolut_fx = eccedenza_fx * RULES_LOADED['piani'][piano]['commissioni']['cambio_valuta_over']
-        risparmio_fx = costo_banca_fx - fee_revolut_fx
-
-        # Interessi
-        interessi = liquidita_media * RULES_LOADED['piani'][piano]['interessi_deposito']
-
-        # RevPoints
-        step = RULES_LOADED['piani'][piano]['revpoints_step']
-        rate = RULES_LOADED['piani'][piano]['revpoints_rate']
-        if rate > 0:
-            punti = (spese * 12 / step) * rate
-            valore_revpoints = punti * 0.01
-        else:
-            valore_revpoints = 0
-
-        # Investimenti
-        risparmio_crypto = (volume_crypto * 12) * (RULES_LOADED['benchmark_banca']['fee_crypto'] - RULES_LOADED['piani'][piano]['commissioni']['crypto'])
-        risparmio_borsa = (volume_borsa * 12) * (RULES_LOADED['benchmark_banca']['fee_borsa'] - RULES_LOADED['piani'][piano]['commissioni']['borsa'])
-
-        # Cashback Pro
-        cashback_pro_val = (revolut_pro * 12) * RULES_LOADED['piani'][piano]['cashback_pro']
-
-        # Valore Partner
-        valore_partner = 0
-        for partner in selected_partners:
-            partner_info = next((p for p in RULES_LOADED['partners_list'] if p['name'] == partner), None)
-            if partner_info:
-                min_plan = partner_info['min_plan']
-                if piano in ['Premium', 'Metal', 'Ultra']:
-                    if min_plan == 'Premium' or (min_plan == 'Metal' and piano in ['Metal', 'Ultra']):
-                        valore_partner += partner_info['val']
-
-        # Totale Netto
-        risparmio_canone = canone * 12
-        risparmio_bonifici = bonifici_istantanei * costo_bonifico + pagopa * costo_pagopa
-        totale_netto = (risparmio_canone + risparmio_bonifici + risparmio_atm + risparmio_fx + interessi + valore_revpoints + cashback_pro_val + risparmio_crypto + risparmio_borsa + valore_partner) - costo_abbonamento
-
-        results.append({
-            'Piano': piano,
-            'Risparmio Canone': risparmio_canone,
-            'Risparmio Bonifici': risparmio_bonifici,
-            'Risparmio ATM': risparmio_atm,
-            'Risparmio FX': risparmio_fx,
-            'Interessi': interessi,
-            'RevPoints': valore_revpoints,
-            'Risparmio Crypto': risparmio_crypto,
-            'Risparmio Borsa': risparmio_borsa,
-            'Cashback Pro': cashback_pro_val,
-            'Valore Partner': valore_partner,
-            'Costo Abbonamento': costo_abbonamento,
-            'Vantaggio Netto': totale_netto
-        })
-
-    df = pd.DataFrame(results)
+    inputs = {
+        'canone': canone, 'bonifici_istantanei': bonifici_istantanei, 'costo_bonifico': costo_bonifico,
+        'pagopa': pagopa, 'costo_pagopa': costo_pagopa, 'spese': spese, 'viaggi': viaggi,
+        'spesa_prelievi_mensile': spesa_prelievi_mensile, 'liquidita_media': liquidita_media,
+        'revolut_pro': revolut_pro, 'volume_crypto': volume_crypto, 'volume_borsa': volume_borsa,
+        'selected_partners': list(selected_partners), 'fatturazione_annuale': fatturazione_annuale,
+        'modalita_duo': modalita_duo
+    }
+    nodi_invariati, nodi_cambiati = track_node_changes(inputs, RULES_VERSION, st.session_state.calc_memo)
+
+    # Risultati condivisi tra sessioni: chi arriva con lo stesso profilo non ricalcola
+    _, df, df_long = compute_scenario(normalize_profile(inputs), RULES_VERSION, RULES_LOADED)
     miglior = df.loc[df['Vantaggio Netto'].idxmax()]
 
     st.markdown("### 🏆 Risultati Analisi")
 
+    # Il profilo finisce nel link (e nella cronologia) solo se l'utente lo chiede
+    condividi = st.toggle("🔗 Crea link condivisibile", key="condividi_link", help="Scrive il tuo scenario (importi inclusi) nella barra degli indirizzi, così puoi copiarlo e condividerlo.")
+    if condividi:
+        sync_query_params(st.query_params, {**inputs, 'lounge': lounge, 'bonifici_int': bonifici_int})
+        st.caption("Il link nella barra degli indirizzi contiene il tuo scenario: copialo per condividerlo.")
+    else:
+        sync_query_params(st.query_params, None)
+
+    with st.expander("⚙️ Dettagli calcolo"):
+        st.caption(f"♻️ Componenti invariati dall'ultimo calcolo: {', '.join(sorted(nodi_invariati)) or 'nessuno'}")
+        st.caption(f"🔄 Componenti con input cambiati: {', '.join(sorted(nodi_cambiati)) or 'nessuno'}")
+        st.caption("I risultati di ogni profilo sono condivisi tra i visitatori: se lo stesso profilo è già stato calcolato, arrivano dalla cache.")
+
     # Trova l'indice del piano migliore per impostarlo come default
     index_miglior = df[df['Piano'] == miglior['Piano']].index[0]
 
@@ -462,11 +428,7 @@ if data_loaded:
                 if modalita_duo:
                     chart_title += " (Modalità Duo Attiva - Prezzi per 2 Persone)"
                 st.subheader(chart_title)
-                # Stacked Bar Chart per componenti
-                df_long = df.melt(id_vars=['Piano'], value_vars=['Risparmio Canone', 'Risparmio Bonifici', 'Risparmio ATM', 'Risparmio FX', 'Interessi', 'RevPoints', 'Risparmio Crypto', 'Risparmio Borsa', 'Cashback Pro', 'Valore Partner', 'Costo Abbonamento'],
-                                  var_name='Componente', value_name='Valore')
-                # Per stacked, rendi negativo il costo
-                df_long['Valore'] = df_long.apply(lambda row: -row['Valore'] if row['Componente'] == 'Costo Abbonamento' else row['Valore'], axis=1)
+                # Stacked Bar Chart per componenti (df_long arriva dalla cache)
                 fig = px.bar(
                     df_long,
                     x='Piano',
@@ -1,4 +1,7 @@
 import json
+import re
+import time
+import threading
 from google import genai
 from google.genai import types
 import streamlit as st
@@ -74,6 +77,79 @@ def ask_gemini_rotated(query, context_rules):
 
     return None
 
+# --- LAYER 2b: PROTEZIONE QUOTA (RATE LIMIT + COALESCING) ---
+class TokenBucket:
+    """
+    Limitatore a gettoni: ogni richiesta consuma un gettone,
+    i gettoni si ricaricano nel tempo fino alla capacità massima.
+    """
+    def __init__(self, capacity, refill_per_sec):
+        self.capacity = capacity
+        self.refill_per_sec = refill_per_sec
+        self.tokens = float(capacity)
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_consume(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.refill_per_sec)
+            self.last_refill = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+# Limite globale condiviso da tutte le sessioni (protegge le chiavi in st.secrets)
+GLOBAL_BUCKET = TokenBucket(capacity=20, refill_per_sec=0.5)
+
+# Domande identiche già in volo: chiave -> {"event", "result", "limited"}
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+def _normalize_query(query):
+    q = re.sub(r"\s+", " ", query.lower()).strip()
+    return q.strip("?!.,; ")
+
+def ask_gemini_shared(query, context_rules, rules_version, session_bucket):
+    """
+    Come ask_gemini_rotated, ma:
+    - se la sessione o il limite globale sono esauriti non chiama Gemini, senza accodare;
+    - domande identiche in volo condividono un'unica chiamata a Gemini.
+    `rules_version` è l'hash delle regole, calcolato una volta sola dall'app.
+    Restituisce (risposta o None, limite_raggiunto).
+    """
+    if not session_bucket.try_consume():
+        print("LOG: Limite sessione raggiunto. Uso il fallback.")
+        return None, True
+
+    key = (_normalize_query(query), rules_version)
+
+    with _inflight_lock:
+        entry = _inflight.get(key)
+        is_leader = entry is None
+        if is_leader:
+            entry = {"event": threading.Event(), "result": None, "limited": False}
+            _inflight[key] = entry
+
+    # Un'altra sessione sta già chiedendo la stessa cosa: aspettiamo la sua risposta
+    if not is_leader:
+        entry["event"].wait(timeout=60)
+        return entry["result"], entry["limited"]
+
+    try:
+        if GLOBAL_BUCKET.try_consume():
+            entry["result"] = ask_gemini_rotated(query, context_rules)
+        else:
+            print("LOG: Limite globale raggiunto. Uso il fallback.")
+            entry["limited"] = True
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+        entry["event"].set()
+
+    return entry["result"], entry["limited"]
+
 # --- LAYER 3: FALLBACK ---
 def get_fallback_response(query):
     """
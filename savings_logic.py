@@ -0,0 +1,245 @@
+import json
+import math
+import hashlib
+import pandas as pd
+import streamlit as st
+
+def rules_hash(rules):
+    """Versione delle regole: cambia solo se cambia il contenuto di rules.json."""
+    return hashlib.sha1(json.dumps(rules, sort_keys=True).encode("utf-8")).hexdigest()
+
+# --- NODI DI CALCOLO (GRAFO DELLE DIPENDENZE) ---
+# Ogni componente del risparmio dichiara i SOLI input (widget) da cui dipende:
+# così si sa quali componenti cambiano quando l'utente modifica un widget.
+
+def _costo_abbonamento(inp, piano, rules):
+    dati = rules['piani'][piano]
+    if inp['fatturazione_annuale']:
+        base = dati['costo_annuale']
+    else:
+        base = dati['costo_mensile'] * 12
+    if inp['modalita_duo']:
+        return base + (dati['costo_duo_addon'] * 12)
+    return base
+
+def _risparmio_canone(inp, piano, rules):
+    return inp['canone'] * 12
+
+def _risparmio_bonifici(inp, piano, rules):
+    return inp['bonifici_istantanei'] * inp['costo_bonifico'] + inp['pagopa'] * inp['costo_pagopa']
+
+def _risparmio_atm(inp, piano, rules):
+    dati = rules['piani'][piano]
+    spesa_prelievi_annui = inp['spesa_prelievi_mensile'] * 12 if inp['spesa_prelievi_mensile'] > 0 else inp['viaggi'] * 200
+    costo_banca_atm = (inp['viaggi'] * 3) * rules['benchmark_banca']['fee_atm_altri']
+    eccedenza_atm = max(0, spesa_prelievi_annui - (dati['limiti']['prelievi_atm'] * 12))
+    fee_revolut_atm = eccedenza_atm * dati['commissioni']['prelievi_atm_over']
+    return costo_banca_atm - fee_revolut_atm
+
+def _risparmio_fx(inp, piano, rules):
+    dati = rules['piani'][piano]
+    spesa_fx_annua = inp['viaggi'] * 500
+    costo_banca_fx = spesa_fx_annua * rules['benchmark_banca']['fee_cambio_valuta']
+    eccedenza_fx = max(0, spesa_fx_annua - (dati['limiti']['cambio_valuta'] * 12))
+    fee_revolut_fx = eccedenza_fx * dati['commissioni']['cambio_valuta_over']
+    return costo_banca_fx - fee_revolut_fx
+
+def _interessi(inp, piano, rules):
+    return inp['liquidita_media'] * rules['piani'][piano]['interessi_deposito']
+
+def _revpoints(inp, piano, rules):
+    step = rules['piani'][piano]['revpoints_step']
+    rate = rules['piani'][piano]['revpoints_rate']
+    if rate > 0:
+        punti = (inp['spese'] * 12 / step) * rate
+        return punti * 0.01
+    return 0
+
+def _risparmio_crypto(inp, piano, rules):
+    return (inp['volume_crypto'] * 12) * (rules['benchmark_banca']['fee_crypto'] - rules['piani'][piano]['commissioni']['crypto'])
+
+def _risparmio_borsa(inp, piano, rules):
+    return (inp['volume_borsa'] * 12) * (rules['benchmark_banca']['fee_borsa'] - rules['piani'][piano]['commissioni']['borsa'])
+
+def _cashback_pro(inp, piano, rules):
+    return (inp['revolut_pro'] * 12) * rules['piani'][piano]['cashback_pro']
+
+def _valore_partner(inp, piano, rules):
+    valore_partner = 0
+    for partner in inp['selected_partners']:
+        partner_info = next((p for p in rules['partners_list'] if p['name'] == partner), None)
+        if partner_info:
+            min_plan = partner_info['min_plan']
+            if piano in ['Premium', 'Metal', 'Ultra']:
+                if min_plan == 'Premium' or (min_plan == 'Metal' and piano in ['Metal', 'Ultra']):
+                    valore_partner += partner_info['val']
+    return valore_partner
+
+class _InputDichiarati(dict):
+    """
+    Vista degli input limitata alle dipendenze dichiarate di un nodo:
+    leggere un input non dichiarato è un errore, non un valore in cache scaduto.
+    """
+    def __init__(self, nome, inputs, dipendenze):
+        super().__init__((d, inputs[d]) for d in dipendenze)
+        self.nome = nome
+
+    def __missing__(self, key):
+        raise KeyError(f"Il nodo '{self.nome}' legge '{key}' senza dichiararlo in NODI")
+
+# Nome colonna -> (input da cui dipende, funzione di calcolo)
+NODI = {
+    'Risparmio Canone': (('canone',), _risparmio_canone),
+    'Risparmio Bonifici': (('bonifici_istantanei', 'costo_bonifico', 'pagopa', 'costo_pagopa'), _risparmio_bonifici),
+    'Risparmio ATM': (('spesa_prelievi_mensile', 'viaggi'), _risparmio_atm),
+    'Risparmio FX': (('viaggi',), _risparmio_fx),
+    'Interessi': (('liquidita_media',), _interessi),
+    'RevPoints': (('spese',), _revpoints),
+    'Risparmio Crypto': (('volume_crypto',), _risparmio_crypto),
+    'Risparmio Borsa': (('volume_borsa',), _risparmio_borsa),
+    'Cashback Pro': (('revolut_pro',), _cashback_pro),
+    'Valore Partner': (('selected_partners',), _valore_partner),
+    'Costo Abbonamento': (('fatturazione_annuale', 'modalita_duo'), _costo_abbonamento),
+}
+
+def compute_plan_results(inputs, rules):
+    """Calcola le righe della tabella risultati per tutti i piani."""
+    results = []
+    for piano in rules['piani']:
+        riga = {'Piano': piano}
+        for nome, (dipendenze, funzione) in NODI.items():
+            riga[nome] = funzione(_InputDichiarati(nome, inputs, dipendenze), piano, rules)
+
+        # Totale Netto
+        riga['Vantaggio Netto'] = (riga['Risparmio Canone'] + riga['Risparmio Bonifici'] + riga['Risparmio ATM'] + riga['Risparmio FX'] + riga['Interessi'] + riga['RevPoints'] + riga['Cashback Pro'] + riga['Risparmio Crypto'] + riga['Risparmio Borsa'] + riga['Valore Partner']) - riga['Costo Abbonamento']
+        results.append(riga)
+    return results
+
+def track_node_changes(inputs, rules_version, memo):
+    """
+    Confronta gli input dichiarati di ogni nodo con quelli del rerun precedente
+    (salvati in `memo`, dict di sessione) e aggiorna il memo.
+    Restituisce (nodi_invariati, nodi_cambiati). Non calcola nulla.
+    """
+    invariati = set()
+    cambiati = set()
+    for nome, (dipendenze, _) in NODI.items():
+        chiave = (rules_version,) + tuple(
+            tuple(sorted(inputs[d])) if isinstance(inputs[d], list) else inputs[d] for d in dipendenze
+        )
+        if memo.get(nome) == chiave:
+            invariati.add(nome)
+        else:
+            memo[nome] = chiave
+            cambiati.add(nome)
+    return invariati, cambiati
+
+# --- PROFILO CONDIVISIBILE (URL) ---
+# Valori di default dei widget: il link contiene solo ciò che differisce
+PROFILO_DEFAULT = {
+    'canone': 10.0, 'bonifici_istantanei': 12, 'costo_bonifico': 2.00, 'pagopa': 12, 'costo_pagopa': 1.50,
+    'spese': 400.0, 'viaggi': 2, 'spesa_prelievi_mensile': 0.0, 'liquidita_media': 1000.0,
+    'lounge': 1, 'bonifici_int': 2, 'revolut_pro': 100.0, 'volume_crypto': 0.0, 'volume_borsa': 0.0,
+    'selected_partners': [], 'fatturazione_annuale': True, 'modalita_duo': False
+}
+
+
+VALORI_VERO = ("1", "true", "yes", "si", "on")
+VALORI_FALSO = ("0", "false", "no", "off")
+
+def decode_profile(query_params, partner_validi):
+    """
+    Legge il profilo dai parametri del link (es. ?spese=800&viaggi=5).
+    Valori mancanti o non validi restano al default; i partner
+    sconosciuti (non presenti in `partner_validi`) vengono scartati.
+    """
+    profilo = dict(PROFILO_DEFAULT)
+    for nome, default in PROFILO_DEFAULT.items():
+        raw = query_params.get(nome)
+        if raw is None:
+            continue
+        try:
+            if isinstance(default, bool):
+                if raw.strip().lower() in VALORI_VERO:
+                    profilo[nome] = True
+                elif raw.strip().lower() in VALORI_FALSO:
+                    profilo[nome] = False
+                else:
+                    raise ValueError(raw)
+            elif isinstance(default, list):
+                # Senza spazi e senza doppioni (l'ordine resta quello del link)
+                partner = list(dict.fromkeys(p.strip() for p in raw.split(",") if p.strip()))
+                for p in partner:
+                    if p not in partner_validi:
+                        print(f"LOG: Partner sconosciuto nel link: {p}")
+                profilo[nome] = [p for p in partner if p in partner_validi]
+            else:
+                valore = type(default)(raw)
+                if not math.isfinite(valore):
+                    raise ValueError(raw)
+                profilo[nome] = max(valore, type(default)(0))
+        except ValueError:
+            print(f"LOG: Parametro '{nome}' non valido nel link: {raw}")
+    return profilo
+
+def encode_profile(profilo):
+    params = {}
+    for nome, default in PROFILO_DEFAULT.items():
+        valore = profilo[nome]
+        if valore == default:
+            continue
+        if isinstance(default, bool):
+            params[nome] = "1" if valore else "0"
+        elif isinstance(default, list):
+            params[nome] = ",".join(valore)
+        elif isinstance(default, int):
+            params[nome] = str(int(valore))
+        else:
+            # repr è esatto: decode_profile rilegge lo stesso float
+            params[nome] = repr(float(valore))
+    return params
+
+def normalize_profile(profilo):
+    """
+    Forma canonica (e hashable) del profilo, usata come chiave della cache.
+    I valori restano esatti: cambia solo l'ordine (chiavi e partner).
+    """
+    normalizzato = {}
+    for nome, valore in profilo.items():
+        if isinstance(valore, list):
+            valore = tuple(sorted(valore))
+        normalizzato[nome] = valore
+    return tuple(sorted(normalizzato.items()))
+
+def sync_query_params(query_params, profilo):
+    """
+    Scrive nel link solo le chiavi del profilo (aggiunge, aggiorna o rimuove).
+    Con profilo=None le chiavi del profilo vengono tolte dal link.
+    Gli altri parametri (source, utm_*, ...) restano invariati.
+    """
+    params = encode_profile(profilo) if profilo is not None else {}
+    for nome in PROFILO_DEFAULT:
+        if nome in params:
+            if query_params.get(nome) != params[nome]:
+                query_params[nome] = params[nome]
+        elif nome in query_params:
+            del query_params[nome]
+
+def profile_inputs(profilo_normalizzato):
+    """Da profilo normalizzato (tuple) al dict di input atteso dai nodi."""
+    return {k: list(v) if isinstance(v, tuple) else v for k, v in profilo_normalizzato}
+
+# --- CACHE CONDIVISA TRA SESSIONI ---
+# Il risultato di un profilo (righe, tabella e dati del grafico) dipende solo
+# da profilo normalizzato e regole: viene calcolato una volta e servito a
+# tutte le sessioni che arrivano con lo stesso profilo (es. stesso link).
+@st.cache_data(max_entries=500, show_spinner=False)
+def compute_scenario(profilo_normalizzato, rules_version, rules):
+    results = compute_plan_results(profile_inputs(profilo_normalizzato), rules)
+    df = pd.DataFrame(results)
+
+    # Stacked Bar Chart per componenti
+    df_long = df.melt(id_vars=['Piano'], value_vars=list(NODI.keys()), var_name='Componente', value_name='Valore')
+    # Per stacked, rendi negativo il costo
+    df_long['Valore'] = df_long.apply(lambda row: -row['Valore'] if row['Componente'] == 'Costo Abbonamento' else row['Valore'], axis=1)
+    return results, df, df_long